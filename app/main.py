@@ -1,10 +1,14 @@
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List
+from typing import Final, List
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from ortools.util import optional_boolean_pb2
 import math
-
-app = FastAPI()
+import numpy as np
+from numba import njit
 
 
 class Point(BaseModel):
@@ -22,114 +26,182 @@ class RouteRequest(BaseModel):
     warehouse: Point
     orders: List[Point]
 
-def travel_time(p1, p2):
-    dist_km = math.sqrt((p1.lat - p2.lat) ** 2 + (p1.lon - p2.lon) ** 2) * 100
-    speed_kmh = 30 # Средняя скорость движения по городу
-    return int((dist_km / speed_kmh) * 60)
 
-def distance(p1, p2):
+EARTH_RADIUS_KM: Final[int] = 6371
+SPEED_KMH: Final[int] = 30  # Средняя скорость движения по городу
+MAX_TOTAL_KG: Final[int] = 270
+RAW_ICE_TIME_LIMIT: Final[int] = 50  # минут
+
+
+@njit(cache=True)
+def build_matrices(lats, lons):
+    """
+    Целочисленные матрицы расстояний (м) и времени в пути (мин) за один проход
+    """
+    n = lats.size
+    lat_r = np.radians(lats)
+    lon_r = np.radians(lons)
+    dist = np.empty((n, n), dtype=np.int64)
+    time = np.empty((n, n), dtype=np.int64)
+    for i in range(n):
+        for j in range(n):
+            dlat = lat_r[i] - lat_r[j]
+            dlon = (lon_r[i] - lon_r[j]) * math.cos((lat_r[i] + lat_r[j]) / 2)
+            d = EARTH_RADIUS_KM * math.sqrt(dlat * dlat + dlon * dlon)
+            dist[i, j] = int(d * 1000 + 0.5)
+            time[i, j] = int(d / SPEED_KMH * 60)
+    return dist, time
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Компиляция ядра при старте, а не внутри первого запроса
+    build_matrices(np.zeros(2), np.zeros(2))
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@lru_cache(maxsize=64)
+def route_geometry(coords):
     """
-    Приближённое расстояние между двумя точками (км)
+    Менеджер индексов и матрицы стоимости для набора координат;
+    переиспользуются запросами, которые отличаются только окнами или весами
     """
-    return math.sqrt(
-        (p1.lat - p2.lat) ** 2 +
-        (p1.lon - p2.lon) ** 2
+    lats, lons = zip(*coords)
+    dist_matrix, time_matrix = build_matrices(
+        np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64)
     )
+    manager = pywrapcp.RoutingIndexManager(len(coords), 1, 0)
+    # Отображение узел <-> индекс решателя, чтобы не ходить в C++ на каждую точку
+    node_to_index = [manager.NodeToIndex(i) for i in range(len(coords))]
+    index_to_node = {index: node for node, index in enumerate(node_to_index)}
+    # Самое раннее прибытие от склада: кратчайший путь по матрице времени
+    # (из-за округления дуг путь через другие точки бывает короче прямого)
+    earliest = time_matrix[0]
+    for _ in range(len(coords)):
+        relaxed = np.minimum(earliest, (earliest[:, None] + time_matrix).min(axis=0))
+        if np.array_equal(relaxed, earliest):
+            break
+        earliest = relaxed
+    return (
+        manager, node_to_index, index_to_node,
+        dist_matrix.tolist(), time_matrix.tolist(), earliest,
+    )
+
 
-@app.post("/build-route")
+@app.post("/build-route", response_class=ORJSONResponse)
 def build_route(data: RouteRequest):
-    MAX_TOTAL_KG = 270
-    RAW_ICE_TIME_LIMIT = 50  # минут
+    # Ключ кэша - только поля, влияющие на маршрут
+    points = tuple(
+        (p.name, p.lat, p.lon, p.time_start, p.time_end, p.ice_kg)
+        for p in [data.warehouse] + data.orders
+    )
+    # Готовый ответ минует jsonable_encoder и сразу кодируется orjson
+    return ORJSONResponse(solve_route(points))
 
-    warehouse = data.warehouse
-    orders = data.orders
 
-    points = [warehouse] + orders
+@lru_cache(maxsize=256)
+def solve_route(points):
+    """
+    Построение маршрута; одинаковые запросы отдаются из кэша без повторного решения
+    """
     size = len(points)
 
+    # Поля точек раскладываются по отдельным массивам (SoA)
+    names, lats, lons, time_start, time_end, ice = zip(*points)
+    time_start = np.array(time_start, dtype=np.int64)
+    time_end = np.array(time_end, dtype=np.int64)
+    ice = np.array(ice, dtype=np.int64)
+
     # --- разделение льда (Логика из ШАГА 3.3 и 3.4) ---
-    for o in orders:
-        if o.ice_kg >= 100:
-            o.raw_ice_kg = o.ice_kg
-            o.container_ice_kg = 0
-        else:
-            o.raw_ice_kg = 0
-            o.container_ice_kg = o.ice_kg
+    raw_mask = ice >= 100
+    raw_mask[0] = False
+    raw = np.where(raw_mask, ice, 0)
+    container = np.where(raw_mask, 0, ice)
 
     # Веса для Capacity Dimension (ШАГ 3.1)
     # Склад загружает всё, заказы выгружают
-    warehouse.raw_ice_kg = sum(o.raw_ice_kg for o in orders)
-    warehouse.container_ice_kg = sum(o.container_ice_kg for o in orders)
-    
-    # Для OR-Tools используем отрицательные значения для выгрузки (demand)
-    # Но в этой реализации мы используем UnaryTransitCallback, который обычно работает с положительным спросом
-    # Пересчитаем для классической модели: склад 0, заказы +вес
-    
-    dist_matrix = [
-        [distance(points[i], points[j]) for j in range(size)]
-        for i in range(size)
-    ]
-
-    manager = pywrapcp.RoutingIndexManager(size, 1, 0)
-    routing = pywrapcp.RoutingModel(manager)
+    raw[0] = raw[1:].sum()
+    container[0] = container[1:].sum()
+
+    # Матрицы расстояний (м) и времени считаются один раз на набор координат;
+    # в поиске решения sqrt больше не вызывается
+    (
+        manager, node_to_index, index_to_node,
+        dist_costs, time_costs, earliest,
+    ) = route_geometry(tuple(zip(lats, lons)))
+
+    # Сырой лед, который не доехать от склада за лимит, отсекаем до запуска решателя
+    unreachable = raw_mask & (earliest > RAW_ICE_TIME_LIMIT)
+    if unreachable.any():
+        late = ", ".join(f"'{names[i]}'" for i in np.flatnonzero(unreachable))
+        return {"error": f"Заказы {late} невозможны (сырой лед растает по дороге от склада)"}
+
+    model_params = pywrapcp.DefaultRoutingModelParameters()
+    # Кэш колбэков: для небольших моделей все пары (from, to) мемоизируются
+    model_params.max_callback_cache_size = 2000
+    # Одна машина и один оценщик стоимости дуг для всех машин
+    model_params.reduce_vehicle_cost_model = True
+    routing = pywrapcp.RoutingModel(manager, model_params)
 
     # ---------- TIME (ШАГ 2) ----------
-    def time_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return travel_time(points[from_node], points[to_node])
-
-    time_cb = routing.RegisterTransitCallback(time_callback)
+    # Матрица хранится на стороне C++, без Python-колбэка на каждую дугу
+    time_cb = routing.RegisterTransitMatrix(time_costs)
     routing.AddDimension(time_cb, 1440, 1440, False, "Time")
     time_dimension = routing.GetDimensionOrDie("Time")
 
     # ---------- CAPACITY (ШАГ 3.1) ----------
-    def demand_callback(from_index):
-        node = manager.IndexToNode(from_index)
-        if node == 0: return 0
-        return points[node].ice_kg
-
-    demand_cb = routing.RegisterUnaryTransitCallback(demand_callback)
+    # Классическая модель: склад 0, заказы +вес
+    demand = ice.tolist()
+    demand[0] = 0
+    demand_cb = routing.RegisterUnaryTransitVector(demand)
     routing.AddDimension(demand_cb, 0, MAX_TOTAL_KG, True, "Capacity")
 
     # ---------- TIME WINDOWS & RAW ICE LIMIT (ШАГ 3.4) ----------
-    for i, point in enumerate(points):
-        index = manager.NodeToIndex(i)
-        
+    for i in range(size):
+        index = node_to_index[i]
+
         if i == 0:
             time_dimension.CumulVar(index).SetRange(0, 1440)
             continue
 
-        start = int(point.time_start)
-        end = int(point.time_end)
+        start = int(time_start[i])
+        end = int(time_end[i])
 
         # Если есть сырой лед (>= 100кг), ограничиваем время доставки 50 минутами
-        if point.raw_ice_kg > 0:
+        if raw_mask[i]:
             end = min(end, RAW_ICE_TIME_LIMIT)
 
         if start > end:
-            return {"error": f"Заказ '{point.name}' невозможен (лед растает раньше начала окна или окно некорректно)"}
+            return {"error": f"Заказ '{names[i]}' невозможен (лед растает раньше начала окна или окно некорректно)"}
 
         time_dimension.CumulVar(index).SetRange(start, end)
 
     # ---------- COST ----------
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return int(dist_matrix[from_node][to_node] * 1000)
-
-    dist_cb = routing.RegisterTransitCallback(distance_callback)
+    dist_cb = routing.RegisterTransitMatrix(dist_costs)
     routing.SetArcCostEvaluatorOfAllVehicles(dist_cb)
 
     # ---------- SOLVER ----------
     search_params = pywrapcp.DefaultRoutingSearchParameters()
     search_params.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+        routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
     )
     search_params.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
     )
     search_params.time_limit.seconds = 5
+    # Бандит выбирает наиболее полезные операторы локального поиска
+    search_params.use_multi_armed_bandit_concatenate_operators = True
+
+    # Дополнительные операторы локального поиска для VRPTW
+    ls_ops = search_params.local_search_operators
+    ls_ops.use_cross = optional_boolean_pb2.BOOL_TRUE
+    ls_ops.use_cross_exchange = optional_boolean_pb2.BOOL_TRUE
+    ls_ops.use_relocate_neighbors = optional_boolean_pb2.BOOL_TRUE
+    ls_ops.use_relocate_subtrip = optional_boolean_pb2.BOOL_TRUE
+    ls_ops.use_tsp_opt = optional_boolean_pb2.BOOL_TRUE
 
     solution = routing.SolveWithParameters(search_params)
 
@@ -142,14 +214,13 @@ def build_route(data: RouteRequest):
     total_weight = 0
 
     while not routing.IsEnd(index):
-        node = manager.IndexToNode(index)
+        node = index_to_node[index]
         arrival = solution.Value(time_dimension.CumulVar(index))
-        point_data = points[node]
         route.append({
-            "point": point_data.name,
+            "point": names[node],
             "arrival_minute": arrival,
-            "ice_kg": point_data.ice_kg,
-            "type": "raw" if point_data.raw_ice_kg > 0 else "container"
+            "ice_kg": int(ice[node]),
+            "type": "raw" if raw[node] > 0 else "container"
         })
         index = solution.Value(routing.NextVar(index))
 
@@ -157,9 +228,9 @@ def build_route(data: RouteRequest):
     node = manager.IndexToNode(index)
     arrival = solution.Value(time_dimension.CumulVar(index))
     route.append({
-        "point": points[node].name,
+        "point": names[node],
         "arrival_minute": arrival,
         "type": "finish"
     })
 
-    return {"route": route, "total_weight_kg": sum(o.ice_kg for o in orders)}
+    return {"route": route, "total_weight_kg": int(ice[1:].sum())}